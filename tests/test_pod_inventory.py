@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+from utils import pod_inventory
+
+
+@pytest.fixture(autouse=True)
+def clear_inventories():
+    pod_inventory.clear()
+    yield
+    pod_inventory.clear()
+
+
+def _fake_prometheus(pods):
+    calls = []
+
+    def query(expr):
+        calls.append(expr)
+        result = [{'metric': {'namespace': namespace, 'pod': pod, 'label_app': 'web'}}
+                  for namespace, pod in pods]
+        return {'data': {'result': result}}
+
+    return query, calls
+
+
+def test_selector_and_pattern_are_served_from_cache():
+    query, calls = _fake_prometheus([('ns', 'frontend-1'), ('ns', 'db-0')])
+
+    assert [p['name'] for p in pod_inventory.get_pods('http://prom', {}, 'ns', 'app=web', '', query)] == \
+        ['db-0', 'frontend-1']
+    assert [p['name'] for p in pod_inventory.get_pods('http://prom', {}, 'ns', '', 'front.*', query)] == \
+        ['frontend-1']
+    assert calls == ['kube_pod_labels{namespace="ns"}']
+
+
+def test_incremental_refresh_drops_deleted_pods():
+    pods = [('ns', 'a-1'), ('ns', 'b-1')]
+    query, calls = _fake_prometheus(pods)
+    pod_inventory.get_pods('http://prom', {}, 'ns', '', '', query)
+
+    pods[:] = [('ns', 'b-1'), ('ns', 'c-1')]
+    pod_inventory._inventories[('http://prom', '', 'ns', '')].refreshed_at -= pod_inventory.INVENTORY_TTL
+
+    names = [p['name'] for p in pod_inventory.get_pods('http://prom', {}, 'ns', '', '', query)]
+    assert names == ['b-1', 'c-1']
+    assert calls[-1] == 'kube_pod_labels{namespace="ns", pod=~"c-1"}'
+
+
+def test_cluster_wide_pattern_is_filtered_on_server():
+    query, calls = _fake_prometheus([('ns', 'frontend-1')])
+    pod_inventory.get_pods('http://prom', {}, '', '', 'front.*', query)
+    assert calls == ['kube_pod_labels{pod=~"front.*"}']
+
+
+def test_invalid_pattern():
+    query, calls = _fake_prometheus([])
+    with pytest.raises(pod_inventory.InvalidPatternError):
+        pod_inventory.get_pods('http://prom', {}, 'ns', '', '(', query)
+    assert calls == []
+
+
+def test_lock_is_not_held_during_queries():
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_query(expr):
+        started.set()
+        release.wait(5)
+        return {'data': {'result': []}}
+
+    worker = threading.Thread(target=pod_inventory.get_pods,
+                              args=('http://prom', {}, 'ns', '', '', slow_query))
+    worker.start()
+    started.wait(5)
+    inventory = pod_inventory._inventories[('http://prom', '', 'ns', '')]
+    assert inventory.lock.acquire(timeout=1)
+    inventory.lock.release()
+    release.set()
+    worker.join(5)
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from utils import http
+from utils.singleflight import SingleFlight
+
+
+def _run_concurrently(flights, fn, count, timeout=5, retry_if=None):
+    results = []
+    barrier = threading.Barrier(count)
+
+    def worker():
+        barrier.wait()
+        results.append(flights.do('key', fn, timeout, retry_if=retry_if))
+
+    threads = [threading.Thread(target=worker) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_identical_calls_are_coalesced():
+    flights = SingleFlight()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    results = _run_concurrently(flights, fn, 5)
+
+    assert [result for result, _ in results] == ['result'] * 5
+    stats = flights.stats()
+    assert stats['coalesced'] > 0
+    assert stats['upstream'] == len(calls) < 5
+    assert stats['requests'] == 5
+    assert stats['in_flight'] == 0
+
+
+def test_followers_retry_alone_when_shared_result_is_rejected():
+    flights = SingleFlight()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.2)
+        # 第一次（领头请求）模拟服务端超时
+        return 'timeout' if len(calls) == 1 else 'ok'
+
+    results = _run_concurrently(flights, fn, 3, retry_if=lambda result: result == 'timeout')
+
+    assert sorted(result for result, _ in results) == ['ok', 'ok', 'timeout']
+    assert flights.stats()['coalesced'] == 0
+    assert flights.stats()['upstream'] == 3
+
+
+def test_follower_stops_waiting_after_its_own_timeout():
+    flights = SingleFlight()
+    release = threading.Event()
+    leader = threading.Thread(target=flights.do, args=('key', lambda: release.wait(5), 5))
+    leader.start()
+    while not flights.stats()['in_flight']:
+        time.sleep(0.01)
+
+    try:
+        with pytest.raises(TimeoutError):
+            flights.do('key', lambda: None, 0.05)
+    finally:
+        release.set()
+        leader.join()
+
+
+def test_flight_key_truncates_times_and_ignores_timeout():
+    first = http._flight_key('http://prom/api/v1/query_range/',
+                             {'query': 'up', 'start': '1700000000.25', 'end': '1700003600.9', 'timeout': '10000ms'},
+                             {}, 1024)
+    second = http._flight_key('http://prom/api/v1/query_range',
+                              {'end': '1700003600', 'query': 'up', 'start': '1700000000', 'timeout': '5000ms'},
+                              {}, 1024)
+    assert first == second
+    assert http._flight_key('http://prom', {'time': '2023-01-01T00:00:00Z'}, {}, 1024) != \
+        http._flight_key('http://prom', {'time': '2023-01-01T00:00:01Z'}, {}, 1024)
@@ -0,0 +1,33 @@
+import pytest
+
+from utils import timeparse
+
+
+@pytest.mark.parametrize('value', ['-1h', '1 hour', 'yesterday', '1h ago'])
+def test_relative_looking_junk_is_rejected(value):
+    with pytest.raises(ValueError):
+        timeparse.parse_timestamp(value, now=1700000000.0)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2023-01-01T00:00:00Z', 1672531200.0),
+    ('20230101T000000Z', 1672531200.0),
+    ('2023-01-01T00:00:00.5+00:00', 1672531200.5),
+])
+def test_iso8601_times(value, expected):
+    assert timeparse.parse_datetime(value) == expected
+
+
+def test_relative_range_uses_whole_seconds(monkeypatch):
+    monkeypatch.setattr(timeparse.time, 'time', lambda: 1700000000.123456)
+
+    start, end, step = timeparse.parse_range('1h', 'now', '15s')
+
+    assert (start, end, step) == (1699996400.0, 1700000000.0, 15.0)
+    assert timeparse.format_seconds(start) == '1699996400'
+
+
+def test_format_seconds():
+    assert timeparse.format_seconds(100) == '100'
+    assert timeparse.format_seconds(99.9999999) == '100'
+    assert timeparse.format_seconds(0.001) == '0.001'
@@ -1,17 +1,28 @@
 from collections.abc import Generator
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 import datetime
+import math
 import requests
-import re
 import pandas as pd
-from dateutil import parser
-import time
 import traceback
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 from dify_plugin.errors.model import InvokeServerUnavailableError
 
+from utils import http, pod_inventory, timeparse
+from utils.deadline import Deadline, HTTP_TIMEOUT_GRACE
+from utils.memory import MemoryTracker
+
+
+# 汇总模式支持的分组维度及显示名称
+ROLLUP_GROUPS = {
+    'namespace': '命名空间',
+    'node': '节点',
+}
+# 汇总模式最多展示的分组数量
+ROLLUP_LIMIT = 50
+
 
 class KubernetesPodMetricsTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
@@ -19,11 +30,24 @@ class KubernetesPodMetricsTool(Tool):
         namespace = tool_parameters.get("namespace", "")
         selector = tool_parameters.get("selector", "")
         pod_name_pattern = tool_parameters.get("pod_name_pattern", "")
+        group_by = tool_parameters.get("group_by") or "pod"
+        if group_by != "pod" and group_by not in ROLLUP_GROUPS:
+            yield self.create_text_message(
+                f"invalid group_by {group_by!r}, expected one of: pod, {', '.join(ROLLUP_GROUPS)}"
+            )
+            return
+        if group_by != "pod" and selector:
+            # 汇总在服务端按namespace/node聚合，标签选择器无法应用，直接提示而不是静默忽略
+            yield self.create_text_message(
+                f"selector is not supported with group_by={group_by!r}, "
+                f"remove the selector or use group_by='pod'"
+            )
+            return
         
         # 获取时间范围参数
-        start_time = tool_parameters.get("start_time", "1h")
-        end_time = tool_parameters.get("end_time", "now")
-        step = tool_parameters.get("step", "1m")
+        start_time = tool_parameters.get("start_time") or "1h"
+        end_time = tool_parameters.get("end_time") or "now"
+        step = tool_parameters.get("step") or "1m"
         
         # 获取Prometheus连接信息
         api_url = tool_parameters.get("api_url")
@@ -40,6 +64,11 @@ class KubernetesPodMetricsTool(Tool):
         if not api_url:
             raise InvokeServerUnavailableError("required api_url")
         
+        # 单次响应体大小限制与内存统计
+        self._max_response_bytes = http.parse_max_response_bytes(
+            self.runtime.credentials.get("max_response_mb")
+        )
+        
         # 构建认证头
         headers = {}
         
@@ -53,157 +82,106 @@ class KubernetesPodMetricsTool(Tool):
         elif token:
             headers["Authorization"] = f"Bearer {token}"
         
+        # 转换时间参数
         try:
-            # 转换时间参数
-            start_timestamp, end_timestamp = self._parse_time_range(start_time, end_time)
-            
-            # 获取Pod信息
-            pod_data = self._get_pod_data(api_url, headers, namespace, selector, pod_name_pattern, 
-                                          start_timestamp, end_timestamp, step)
-            
-            # 格式化为Markdown表格
-            if pod_data:
-                markdown_table = self._create_markdown_table(pod_data)
-                yield self.create_text_message(markdown_table)
-            else:
-                yield self.create_text_message("no pod found")
-            
-        except Exception as e:
-            traceback.print_exc()
-            raise InvokeServerUnavailableError(f"get pod metrics error: {str(e)}") from e
-            
-    def _parse_time_range(self, start_time: str, end_time: str) -> tuple:
-        """解析时间范围参数，支持相对时间和绝对时间"""
-        # 处理结束时间
-        if end_time.lower() == 'now':
-            end_timestamp = int(time.time())
-        else:
-            # 尝试解析为绝对时间
-            try:
-                end_timestamp = int(parser.parse(end_time).timestamp())
-            except:
-                # 尝试解析为相对时间
-                end_timestamp = int(time.time())
-                
-        # 处理开始时间
-        try:
-            # 尝试解析为绝对时间
-            start_timestamp = int(parser.parse(start_time).timestamp())
-        except:
-            # 尝试解析为相对时间
-            start_timestamp = self._parse_relative_time(start_time, end_timestamp)
-            
-        return start_timestamp, end_timestamp
-    
-    def _parse_relative_time(self, time_str: str, reference_time: int) -> int:
-        """解析相对时间，如 1h, 2d, 3w 等"""
-        units = {
-            's': 1,
-            'm': 60,
-            'h': 3600,
-            'd': 86400,
-            'w': 604800,
-        }
+            start_timestamp, end_timestamp, step_seconds = timeparse.parse_range(start_time, end_time, step)
+        except ValueError as e:
+            yield self.create_text_message(f"invalid time range: {str(e)}")
+            return
+        step = timeparse.format_seconds(step_seconds)
         
-        match = re.match(r'^(\d+)([smhdw])$', time_str)
-        if match:
-            value, unit = match.groups()
-            seconds = int(value) * units[unit]
-            return reference_time - seconds
+        # 整个调用的时间预算，平均分配给各个子查询
+        self._deadline = Deadline()
         
-        # 默认为1小时前
-        return reference_time - 3600
+        with MemoryTracker("kubernetes_pod_metrics") as self._tracker:
+            try:
+                # 按命名空间/节点汇总，在服务端聚合
+                if group_by in ROLLUP_GROUPS:
+                    rollup_data = self._get_rollup_data(api_url, headers, group_by, namespace, pod_name_pattern,
+                                                        start_timestamp, end_timestamp, step)
+                    if rollup_data:
+                        markdown_table = self._create_rollup_table(rollup_data, group_by)
+                    else:
+                        markdown_table = f"no {group_by} found"
+                    yield self.create_text_message(self._with_skipped(markdown_table))
+                    return
+                
+                # 获取Pod信息
+                pod_data = self._get_pod_data(api_url, headers, namespace, selector, pod_name_pattern, 
+                                              start_timestamp, end_timestamp, step)
+                
+                # 格式化为Markdown表格
+                if pod_data:
+                    markdown_table = self._create_markdown_table(pod_data)
+                    yield self.create_text_message(self._with_skipped(markdown_table))
+                else:
+                    yield self.create_text_message(self._with_skipped("no pod found"))
+                
+            except pod_inventory.InvalidPatternError as e:
+                yield self.create_text_message(str(e))
+            except http.ResponseTooLargeError as e:
+                yield self.create_text_message(f"get pod metrics aborted: {str(e)}")
+            except Exception as e:
+                traceback.print_exc()
+                raise InvokeServerUnavailableError(f"get pod metrics error: {str(e)}") from e
             
     def _get_pod_data(self, api_url: str, headers: Dict[str, str], 
                      namespace: str, selector: str, pod_name_pattern: str,
-                     start_timestamp: int, end_timestamp: int, step: str) -> List[Dict[str, Any]]:
+                     start_timestamp: float, end_timestamp: float, step: str) -> List[Dict[str, Any]]:
         """获取Pod的资源使用数据"""
         result = []
         
-        # 构建Pod查询表达式
-        namespace_filter = f'namespace="{namespace}"' if namespace else ''
-        selector_filter = ''
-        if selector:
-            # 将selector (key=value,key2=value2) 转换为Prometheus查询格式
-            selectors = selector.split(',')
-            for s in selectors:
-                if '=' in s:
-                    k, v = s.strip().split('=', 1)
-                    selector_filter += f', {k}="{v}"'
-        
-        # 1. 获取pod列表 - 使用kube_pod_info指标
-        pod_query = 'kube_pod_labels'
-        if namespace_filter or selector_filter or pod_name_pattern:
-            pod_query += '{' + namespace_filter
-
-            if namespace_filter and selector_filter:
-                pod_query += selector_filter
-            if pod_name_pattern:
-                if pod_query[-1] == '{':
-                    pod_query += f'pod=~"{pod_name_pattern}"'
-                else:
-                    pod_query += f', pod=~"{pod_name_pattern}"'
-            pod_query += '}'
-            
-        pod_data = self._query_prometheus(api_url, headers, pod_query)
+        # 1. 获取pod列表 - 从缓存的kube_pod_labels清单中本地过滤
+        self._deadline.plan(10)
+        pods = pod_inventory.get_pods(
+            api_url, headers, namespace, selector, pod_name_pattern,
+            lambda query: self._query_prometheus(api_url, headers, query, name='pod_inventory'),
+            limit=20  # 限制最多查询20个pod
+        )
 
-        if not pod_data or not pod_data.get('data', {}).get('result', []):
+        if not pods:
             return result
         
-        # 过滤pod名称
-        pods = []
-        for item in pod_data.get('data', {}).get('result', []):
-            if len(pods) >= 20: # 限制最多查询20个pod
-                break
-            pod_name = item.get('metric', {}).get('pod', '')
-            pod_namespace = item.get('metric', {}).get('namespace', '')
-            node = item.get('metric', {}).get('node', '')
-                
-            pods.append({
-                'name': pod_name,
-                'namespace': pod_namespace,
-                'node': node
-            })
-        
         # 2. 查询指定时间范围内的指标数据
         if pods:
             # 批量查询所有pod的CPU使用率
             pod_names = '|'.join([pod.get('name') for pod in pods])
+            self._deadline.plan(9)
             
             # 使用范围查询API获取时间序列数据
             # CPU使用率随时间变化
             cpu_query = f'sum(irate(container_cpu_usage_seconds_total{{pod=~"{pod_names}",container !="",container!="POD"}}[1m])) by (pod) / (sum(container_spec_cpu_quota{{pod=~"{pod_names}",container !="",container!="POD"}}/100000) by (pod)) * 100'
             cpu_range_data = self._query_prometheus_range(api_url, headers, cpu_query, 
-                                                       start_timestamp, end_timestamp, step)
+                                                       start_timestamp, end_timestamp, step, name='cpu_usage')
             
             # 内存使用率随时间变化
             memory_query = f'sum (container_memory_working_set_bytes{{pod=~"{pod_names}",container !="",container!="POD"}}) by (pod)/ sum(container_spec_memory_limit_bytes{{pod=~"{pod_names}",container !="",container!="POD"}}) by (pod) * 100'
             memory_range_data = self._query_prometheus_range(api_url, headers, memory_query, 
-                                                         start_timestamp, end_timestamp, step)
+                                                         start_timestamp, end_timestamp, step, name='memory_usage')
             
             # 重启次数变化
             restart_query = f'sum by (pod) (kube_pod_container_status_restarts_total{{pod=~"{pod_names}"}})'
             restart_range_data = self._query_prometheus_range(api_url, headers, restart_query, 
-                                                           start_timestamp, end_timestamp, step)
+                                                           start_timestamp, end_timestamp, step, name='restart_count')
             
             # 查询其他即时指标
             cpu_request_query = f'sum by (pod) (kube_pod_container_resource_requests{{pod=~"{pod_names}",resource="cpu"}})'
-            cpu_request_data = self._query_prometheus(api_url, headers, cpu_request_query)
+            cpu_request_data = self._query_prometheus(api_url, headers, cpu_request_query, name='cpu_request')
             
             cpu_limit_query = f'sum by (pod) (kube_pod_container_resource_limits{{pod=~"{pod_names}",resource="cpu"}})'
-            cpu_limit_data = self._query_prometheus(api_url, headers, cpu_limit_query)
+            cpu_limit_data = self._query_prometheus(api_url, headers, cpu_limit_query, name='cpu_limit')
             
             memory_request_query = f'sum by (pod) (kube_pod_container_resource_requests{{pod=~"{pod_names}",resource="memory"}})'
-            memory_request_data = self._query_prometheus(api_url, headers, memory_request_query)
+            memory_request_data = self._query_prometheus(api_url, headers, memory_request_query, name='memory_request')
             
             memory_limit_query = f'sum by (pod) (kube_pod_container_resource_limits{{pod=~"{pod_names}",resource="memory"}})'
-            memory_limit_data = self._query_prometheus(api_url, headers, memory_limit_query)
+            memory_limit_data = self._query_prometheus(api_url, headers, memory_limit_query, name='memory_limit')
             
             phase_query = f'kube_pod_status_phase{{pod=~"{pod_names}",phase=~"Running|Pending|Failed|Succeeded|Unknown"}}'
-            phase_data = self._query_prometheus(api_url, headers, phase_query)
+            phase_data = self._query_prometheus(api_url, headers, phase_query, name='phase')
             
             uptime_query = f'time() - kube_pod_start_time{{pod=~"{pod_names}"}}'
-            uptime_data = self._query_prometheus(api_url, headers, uptime_query)
+            uptime_data = self._query_prometheus(api_url, headers, uptime_query, name='uptime')
             
             # 处理数据
             for pod in pods:
@@ -294,47 +272,147 @@ class KubernetesPodMetricsTool(Tool):
                 
         return result
     
-    def _query_prometheus(self, api_url: str, headers: Dict[str, str], query: str) -> Dict[str, Any]:
+    def _get_rollup_data(self, api_url: str, headers: Dict[str, str], group_by: str,
+                         namespace: str, pod_name_pattern: str,
+                         start_timestamp: float, end_timestamp: float, step: str) -> List[Dict[str, Any]]:
+        """
+        按命名空间或节点汇总资源使用数据
+
+        所有聚合都在Prometheus端完成（sum by），返回的序列数只与分组数量有关，与Pod数量无关
+        """
+        matchers = ''
+        if namespace:
+            matchers += f',namespace="{namespace}"'
+        if pod_name_pattern:
+            matchers += f',pod=~"{pod_name_pattern}"'
+        container_matchers = f'container!="",container!="POD"{matchers}'
+        pod_matchers = matchers.lstrip(',')
+        
+        def rollup(expr: str) -> str:
+            # cAdvisor/重启指标不一定带node标签，按节点汇总时通过kube_pod_info关联
+            if group_by == 'node':
+                expr = (f'sum by (namespace, pod) ({expr}) * on (namespace, pod) '
+                        f'group_left(node) max by (namespace, pod, node) (kube_pod_info{{{pod_matchers}}})')
+            return f'sum by ({group_by}) ({expr})'
+        
+        period = int(max(end_timestamp - start_timestamp, 60))
+        self._deadline.plan(8)
+        
+        # 随时间变化的使用量
+        cpu_range_data = self._query_prometheus_range(
+            api_url, headers, rollup(f'rate(container_cpu_usage_seconds_total{{{container_matchers}}}[5m])'),
+            start_timestamp, end_timestamp, step, name='cpu_usage')
+        memory_range_data = self._query_prometheus_range(
+            api_url, headers, rollup(f'container_memory_working_set_bytes{{{container_matchers}}}'),
+            start_timestamp, end_timestamp, step, name='memory_usage')
+        
+        # 结束时刻的即时值
+        instant_queries = {
+            'pod_count': f'count by ({group_by}) (kube_pod_info{{{pod_matchers}}})',
+            'cpu_request': f'sum by ({group_by}) (kube_pod_container_resource_requests{{resource="cpu"{matchers}}})',
+            'cpu_limit': f'sum by ({group_by}) (kube_pod_container_resource_limits{{resource="cpu"{matchers}}})',
+            'memory_request': f'sum by ({group_by}) (kube_pod_container_resource_requests{{resource="memory"{matchers}}})',
+            'memory_limit': f'sum by ({group_by}) (kube_pod_container_resource_limits{{resource="memory"{matchers}}})',
+            'restart_count_period': rollup(f'increase(kube_pod_container_status_restarts_total{{{pod_matchers}}}[{period}s])'),
+        }
+        
+        groups: Dict[str, Dict[str, Any]] = {}
+        
+        def group_stats(name: str) -> Dict[str, Any]:
+            return groups.setdefault(name, {'name': name})
+        
+        for key, range_data in (('cpu_usage', cpu_range_data), ('memory_usage', memory_range_data)):
+            for series in range_data.get('data', {}).get('result', []) if range_data else []:
+                name = series.get('metric', {}).get(group_by, '')
+                # 丢弃 NaN/Inf 样本，避免污染平均值和排序
+                values = [value for value in (float(v[1]) for v in series.get('values', []))
+                          if math.isfinite(value)]
+                if not name or not values:
+                    continue
+                stats = group_stats(name)
+                stats[f'{key}_curr'] = values[-1]
+                stats[f'{key}_avg'] = sum(values) / len(values)
+                stats[f'{key}_max'] = max(values)
+        
+        for key, query in instant_queries.items():
+            data = self._query_prometheus(api_url, headers, query, end_timestamp, name=key)
+            for item in data.get('data', {}).get('result', []) if data else []:
+                name = item.get('metric', {}).get(group_by, '')
+                if name and item.get('value', []):
+                    value = float(item['value'][1])
+                    if math.isfinite(value):
+                        group_stats(name)[key] = value
+        
+        # 按CPU使用量排序，其次按内存使用量
+        ranked = sorted(groups.values(),
+                        key=lambda g: (g.get('cpu_usage_curr', 0), g.get('memory_usage_curr', 0)),
+                        reverse=True)
+        return ranked[:ROLLUP_LIMIT]
+    
+    def _query_prometheus(self, api_url: str, headers: Dict[str, str], query: str,
+                          eval_time: Optional[float] = None, name: str = '') -> Dict[str, Any]:
         """向Prometheus发送即时查询请求"""
         query_url = f"{api_url}/api/v1/query"
         params = {"query": query}
+        if eval_time is not None:
+            params["time"] = timeparse.format_seconds(eval_time)
         
-        response = requests.get(
-            query_url,
-            params=params,
-            headers=headers,
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            print("query prometheus response: ", response)
-            return {}
-        
-        return response.json()
+        return self._send_query(query_url, headers, params, name or query)
     
     def _query_prometheus_range(self, api_url: str, headers: Dict[str, str], 
-                             query: str, start: int, end: int, step: str) -> Dict[str, Any]:
+                             query: str, start: float, end: float, step: str, name: str = '') -> Dict[str, Any]:
         """向Prometheus发送范围查询请求"""
         query_url = f"{api_url}/api/v1/query_range"
         params = {
             "query": query,
-            "start": start,
-            "end": end,
+            "start": timeparse.format_seconds(start),
+            "end": timeparse.format_seconds(end),
             "step": step
         }
         
-        response = requests.get(
-            query_url,
-            params=params,
-            headers=headers,
-            timeout=30
-        )
+        return self._send_query(query_url, headers, params, name or query)
+    
+    def _send_query(self, query_url: str, headers: Dict[str, str],
+                    params: Dict[str, Any], name: str) -> Dict[str, Any]:
+        """
+        在剩余时间预算内发送查询，预算通过timeout参数传给Prometheus，
+        由服务端取消超时的查询；预算不足或超时的查询记录为已跳过
+        """
+        timeout = self._deadline.next_timeout()
+        if timeout is None:
+            self._deadline.skip(name)
+            return {}
+        params["timeout"] = f"{int(timeout * 1000)}ms"
+        
+        try:
+            status_code, result = http.get_json(
+                query_url,
+                params=params,
+                headers=headers,
+                timeout=timeout + HTTP_TIMEOUT_GRACE,
+                max_bytes=self._max_response_bytes,
+                tracker=self._tracker
+            )
+        except requests.Timeout:
+            self._deadline.skip(name)
+            return {}
+        
+        if http.is_query_timeout(status_code, result):
+            self._deadline.skip(name)
+            return {}
         
-        if response.status_code != 200:
-            print("query prometheus response: ", response)
+        if status_code != 200:
+            print("query prometheus response: ", status_code, result)
             return {}
         
-        return response.json()
+        return result
+    
+    def _with_skipped(self, text: str) -> str:
+        """在结果后附加因时间预算不足而跳过的查询列表"""
+        skipped_message = self._deadline.skipped_message()
+        if not skipped_message:
+            return text
+        return f"{text}\n\n{skipped_message}"
     
     def _create_markdown_table(self, pod_data: List[Dict[str, Any]]) -> str:
         """将Pod数据转换为Markdown表格"""
@@ -458,4 +536,53 @@ class KubernetesPodMetricsTool(Tool):
         # 生成Markdown表格
         markdown_table = f"### Kubernetes Pod资源使用情况\n\n"
         markdown_table += df.to_markdown(index=False)
-        return markdown_table 
\ No newline at end of file
+        return markdown_table 
+    
+    def _create_rollup_table(self, rollup_data: List[Dict[str, Any]], group_by: str) -> str:
+        """将按命名空间/节点汇总的数据转换为Markdown表格"""
+        def format_cores(value):
+            if pd.isna(value):
+                return "N/A"
+            return f"{round(value * 1000)}m"
+        
+        def format_bytes(value):
+            if pd.isna(value):
+                return "N/A"
+            mib = value / (1024 * 1024)
+            if mib >= 1024:
+                return f"{round(mib / 1024, 1)} GiB"
+            return f"{round(mib)} MiB"
+        
+        df = pd.DataFrame(rollup_data)
+        
+        columns = {
+            'name': ROLLUP_GROUPS[group_by],
+            'pod_count': 'Pod数量',
+            'cpu_usage_curr': 'CPU使用量最近值',
+            'cpu_usage_avg': 'CPU使用量平均值',
+            'cpu_usage_max': 'CPU使用量最大值',
+            'cpu_request': 'CPU请求',
+            'cpu_limit': 'CPU限制',
+            'memory_usage_curr': '内存使用量最近值',
+            'memory_usage_avg': '内存使用量平均值',
+            'memory_usage_max': '内存使用量最大值',
+            'memory_request': '内存请求',
+            'memory_limit': '内存限制',
+            'restart_count_period': '周期内重启次数',
+        }
+        for col in columns:
+            if col not in df.columns:
+                df[col] = float('nan')
+        
+        for col in ('cpu_usage_curr', 'cpu_usage_avg', 'cpu_usage_max', 'cpu_request', 'cpu_limit'):
+            df[col] = df[col].apply(format_cores)
+        for col in ('memory_usage_curr', 'memory_usage_avg', 'memory_usage_max', 'memory_request', 'memory_limit'):
+            df[col] = df[col].apply(format_bytes)
+        for col in ('pod_count', 'restart_count_period'):
+            df[col] = df[col].apply(lambda x: int(round(x)) if pd.notnull(x) else 0)
+        
+        df = df[list(columns)].rename(columns=columns)
+        
+        markdown_table = f"### Kubernetes {ROLLUP_GROUPS[group_by]}资源使用排行\n\n"
+        markdown_table += df.to_markdown(index=False)
+        return markdown_table
\ No newline at end of file
@@ -1,10 +1,10 @@
 from collections.abc import Generator
 from typing import Any, Optional, Dict
 import datetime
-import requests
-from dateutil import parser
-from dateutil.relativedelta import relativedelta
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
@@ -14,6 +14,11 @@ from dify_plugin.errors.model import (
 )
 
 import traceback
+import requests
+
+from utils import http, timeparse
+from utils.deadline import Deadline, HTTP_TIMEOUT_GRACE
+from utils.memory import MemoryTracker
 
 class PrometheusTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
@@ -24,9 +29,10 @@ class PrometheusTool(Tool):
             return
 
         # 获取可选参数
-        start_time = tool_parameters.get("start_time", "1h")  # 默认查询过去1小时
-        end_time = tool_parameters.get("end_time", "now")  # 默认当前时间
-        step = tool_parameters.get("step", "15s")  # 默认步长15秒
+        start_time = tool_parameters.get("start_time") or "1h"  # 默认查询过去1小时
+        end_time = tool_parameters.get("end_time") or "now"  # 默认当前时间
+        step = tool_parameters.get("step") or "15s"  # 默认步长15秒
+        output_format = tool_parameters.get("output_format") or "json"  # 默认输出JSON
         
         # 获取Prometheus服务器连接信息
         api_url = tool_parameters.get("api_url")
@@ -43,6 +49,9 @@ class PrometheusTool(Tool):
         if not api_url:
             raise InvokeServerUnavailableError("required api_url")
 
+        max_response_bytes = http.parse_max_response_bytes(
+            self.runtime.credentials.get("max_response_mb")
+        )
         
         # 构建认证头
         headers = {}
@@ -58,98 +67,154 @@ class PrometheusTool(Tool):
             headers["Authorization"] = f"Bearer {token}"
         
         # 处理时间参数
-        start_timestamp = self._parse_time(start_time)
-        end_timestamp = self._parse_time(end_time)
-        
         try:
-            # 构建查询URL
-            query_url = f"{api_url}/api/v1/query_range"
-            params = {
-                "query": query,
-                "start": start_timestamp,
-                "end": end_timestamp,
-                "step": step
-            }
+            start_timestamp, end_timestamp, step_seconds = timeparse.parse_range(start_time, end_time, step)
+        except ValueError as e:
+            yield self.create_text_message(f"invalid time range: {str(e)}")
+            return
+        
+        # 整个调用的时间预算，通过timeout参数（整数毫秒）传给Prometheus由服务端取消超时的查询
+        deadline = Deadline()
+        
+        with MemoryTracker("prometheus") as tracker:
+            try:
+                # 构建查询URL
+                query_url = f"{api_url}/api/v1/query_range"
+                params = {
+                    "query": query,
+                    "start": timeparse.format_seconds(start_timestamp),
+                    "end": timeparse.format_seconds(end_timestamp),
+                    "step": timeparse.format_seconds(step_seconds)
+                }
+                timeout = deadline.next_timeout()
+                params["timeout"] = f"{int(timeout * 1000)}ms"
             
-            # 发送请求
-            response = requests.get(
-                query_url,
-                params=params,
-                headers=headers,
-                timeout=30
-            )
+                # 发送请求，以流式方式读取并限制响应体大小
+                status_code, result = http.get_json(
+                    query_url,
+                    params=params,
+                    headers=headers,
+                    timeout=timeout + HTTP_TIMEOUT_GRACE,
+                    max_bytes=max_response_bytes,
+                    tracker=tracker
+                )
             
-            # 检查响应
-            if response.status_code != 200:
-                error_message = f"query failed: HTTP {response.status_code}, {response.text}"
-                yield self.create_text_message(error_message)
-                return
+                # 检查响应
+                if http.is_query_timeout(status_code, result):
+                    yield self.create_text_message(
+                        f"query timed out after {timeout:.0f}s, use a larger step, a shorter time range or a narrower selector"
+                    )
+                    return
+                if status_code != 200:
+                    error_message = f"query failed: HTTP {status_code}, {result}"
+                    yield self.create_text_message(error_message)
+                    return
             
-            # 解析响应
-            result = response.json()
+                # 列式二进制导出，只返回简要的文本摘要
+                if output_format in ("arrow", "parquet") and result.get("status") == "success" \
+                        and result.get("data", {}).get("resultType") == "matrix":
+                    yield from self._export_columnar(result, output_format)
+                    return
             
-            # 格式化输出
-            formatted_result = self._format_result(result)
+                # 格式化输出
+                formatted_result = self._format_result(result)
             
-            # 创建Markdown表格
-            markdown_table = self._create_markdown_table(formatted_result)
+                # 创建Markdown表格
+                markdown_table = self._create_markdown_table(formatted_result)
             
-            # 返回结果
-            yield self.create_text_message(markdown_table)
-            yield self.create_json_message(formatted_result)
+                # 返回结果
+                yield self.create_text_message(markdown_table)
+                yield self.create_json_message(formatted_result)
             
-        except Exception as e:
-            print(traceback.print_exc())
-            raise InvokeServerUnavailableError(f"query error: {str(e)}") from e
+            except http.ResponseTooLargeError as e:
+                yield self.create_text_message(f"query aborted: {str(e)}")
+            except requests.Timeout:
+                yield self.create_text_message(
+                    "query timed out, use a larger step, a shorter time range or a narrower selector"
+                )
+            except Exception as e:
+                print(traceback.print_exc())
+                raise InvokeServerUnavailableError(f"query error: {str(e)}") from e
     
-    def _parse_time(self, time_str: str) -> str:
+    def _export_columnar(self, result: Dict[str, Any], output_format: str) -> Generator[ToolInvokeMessage]:
         """
-        解析时间字符串，支持以下格式:
-        - 'now': 当前时间
-        - 相对时间格式: '1h', '2d', '3w', '4m', '5y' 等
-        - RFC3339/ISO8601格式: '2023-01-01T00:00:00Z'
+        将矩阵结果编码为 Arrow IPC 或 Parquet 并以blob消息返回，
+        文本消息中只保留摘要信息
+        """
+        table = self._create_arrow_table(result.get("data", {}).get("result", []))
+        
+        sink = pa.BufferOutputStream()
+        if output_format == "parquet":
+            pq.write_table(table, sink, compression="zstd", use_dictionary=True)
+            mime_type = "application/vnd.apache.parquet"
+        else:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            mime_type = "application/vnd.apache.arrow.file"
+        blob = sink.getvalue().to_pybytes()
         
-        返回Unix时间戳
+        summary = {
+            "success": True,
+            "result_type": "matrix",
+            "format": output_format,
+            "series": len(result["data"].get("result", [])),
+            "samples": table.num_rows,
+            "columns": table.column_names,
+            "bytes": len(blob),
+        }
+        if table.num_rows:
+            timestamps = table.column("timestamp")
+            summary["start"] = pc.min(timestamps).as_py().isoformat()
+            summary["end"] = pc.max(timestamps).as_py().isoformat()
+        
+        yield self.create_text_message(
+            f"exported {summary['series']} series / {summary['samples']} samples "
+            f"as {output_format} ({summary['bytes']} bytes)"
+        )
+        yield self.create_json_message(summary)
+        yield self.create_blob_message(blob, meta={"mime_type": mime_type, "filename": f"prometheus.{output_format}"})
+    
+    def _create_arrow_table(self, series_list: list) -> pa.Table:
         """
-        now = datetime.datetime.now()
+        将矩阵结果转换为长表格式的Arrow表:
+        metric、各标签列（字典编码）、timestamp、value
+        """
+        label_keys = sorted({key for series in series_list for key in series.get("metric", {}) if key != "__name__"})
         
-        if time_str == "now":
-            return str(int(now.timestamp()))
+        # 每个序列的标签值只记录一次，再按样本数重复索引，避免逐样本构造字典
+        metric_names: list = []
+        label_values: Dict[str, list] = {key: [] for key in label_keys}
+        series_index: list = []
+        timestamps: list = []
+        values: list = []
+        for i, series in enumerate(series_list):
+            metric = series.get("metric", {})
+            metric_names.append(metric.get("__name__", "unknown"))
+            for key in label_keys:
+                label_values[key].append(metric.get(key))
+            
+            for value_pair in series.get("values", []):
+                if len(value_pair) < 2:
+                    continue
+                timestamp, value = value_pair[0], value_pair[1]
+                try:
+                    numeric_value = float(value)
+                except (ValueError, TypeError):
+                    numeric_value = None
+                series_index.append(i)
+                timestamps.append(int(float(timestamp) * 1000))
+                values.append(numeric_value)
         
-        # 尝试解析为相对时间
-        if time_str.endswith(('s', 'm', 'h', 'd', 'w', 'M', 'y')):
-            unit = time_str[-1]
-            try:
-                value = int(time_str[:-1])
-                
-                if unit == 's':  # 秒
-                    delta = datetime.timedelta(seconds=value)
-                elif unit == 'm':  # 分钟
-                    delta = datetime.timedelta(minutes=value)
-                elif unit == 'h':  # 小时
-                    delta = datetime.timedelta(hours=value)
-                elif unit == 'd':  # 天
-                    delta = datetime.timedelta(days=value)
-                elif unit == 'w':  # 周
-                    delta = datetime.timedelta(weeks=value)
-                elif unit == 'M':  # 月
-                    delta = relativedelta(months=value)
-                elif unit == 'y':  # 年
-                    delta = relativedelta(years=value)
-                
-                target_time = now - delta
-                return str(int(target_time.timestamp()))
-            except (ValueError, TypeError):
-                pass
+        indices = pa.array(series_index, type=pa.int32())
+        columns = {"metric": pa.array(metric_names, type=pa.string()).take(indices).dictionary_encode()}
+        for key in label_keys:
+            # 与固定列同名的标签加上 label_ 前缀
+            column_name = f"label_{key}" if key in ("metric", "timestamp", "value") else key
+            columns[column_name] = pa.array(label_values[key], type=pa.string()).take(indices).dictionary_encode()
+        columns["timestamp"] = pa.array(timestamps, type=pa.timestamp("ms", tz="UTC"))
+        columns["value"] = pa.array(values, type=pa.float64())
         
-        # 尝试解析为绝对时间
-        try:
-            dt = parser.parse(time_str)
-            return str(int(dt.timestamp()))
-        except parser.ParserError:
-            # 如果解析失败，返回1小时前作为默认值
-            default_time = now - datetime.timedelta(hours=1)
-            return str(int(default_time.timestamp()))
+        return pa.table(columns)
     
     def _format_result(self, result: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -239,7 +304,7 @@ class PrometheusTool(Tool):
             # 找出最新的数据点（按timestamp排序）
             try:
                 # 按timestamp对values进行排序
-                sorted_values = sorted(values, key=lambda x: parser.parse(x.get("timestamp", "1970-01-01T00:00:00")), reverse=True)
+                sorted_values = sorted(values, key=lambda x: timeparse.parse_datetime(x.get("timestamp", "1970-01-01T00:00:00")), reverse=True)
                 
                 # 获取第一个(最新的)数据点
                 if sorted_values:
@@ -290,7 +355,7 @@ class PrometheusTool(Tool):
                 # 格式化timestamp列
                 try:
                     table_df["timestamp"] = table_df["timestamp"].apply(
-                        lambda ts: parser.parse(ts).strftime('%Y-%m-%dT%H:%M:%S')
+                        lambda ts: datetime.datetime.fromtimestamp(timeparse.parse_datetime(ts)).strftime('%Y-%m-%dT%H:%M:%S')
                     )
                 except Exception:
                     pass
@@ -0,0 +1,49 @@
+from typing import List, Optional
+import time
+
+# 单次调用的总时间预算（秒），需小于 main.py 中的 MAX_REQUEST_TIMEOUT，为结果格式化留出余量
+DEFAULT_DEADLINE = 100
+# 剩余时间低于该值（秒）时不再发起新的查询
+MIN_QUERY_TIMEOUT = 1.0
+# HTTP超时比Prometheus服务端超时多留的时间（秒），让服务端先取消查询
+HTTP_TIMEOUT_GRACE = 2.0
+
+
+class Deadline:
+    """
+    单次工具调用的截止时间
+
+    剩余时间平均分配给尚未执行的子查询，每个子查询的预算通过 Prometheus 的
+    timeout 参数传给服务端；预算耗尽后的查询被跳过并记录在 skipped 中。
+    """
+
+    def __init__(self, seconds: float = DEFAULT_DEADLINE):
+        self.expires_at = time.monotonic() + seconds
+        self.skipped: List[str] = []
+        self._pending = 1
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def plan(self, count: int) -> None:
+        """声明接下来还要执行的子查询数量"""
+        self._pending = max(count, 1)
+
+    def next_timeout(self) -> Optional[float]:
+        """
+        取下一个子查询的时间预算（秒），时间不足时返回 None
+        """
+        pending = max(self._pending, 1)
+        self._pending = pending - 1
+        remaining = self.remaining()
+        if remaining < MIN_QUERY_TIMEOUT:
+            return None
+        return remaining / pending
+
+    def skip(self, name: str) -> None:
+        self.skipped.append(name)
+
+    def skipped_message(self) -> str:
+        if not self.skipped:
+            return ""
+        return f"skipped (time budget exceeded): {', '.join(self.skipped)}"
@@ -0,0 +1,131 @@
+from typing import Any, Optional
+import hashlib
+import json
+
+import requests
+
+from utils.singleflight import SingleFlight
+
+# 默认最大响应体大小（MB）需要远小于插件的内存上限（manifest.yaml 中为256MB），
+# 因为 json.loads 解码后的对象通常是原始字节的数倍
+DEFAULT_MAX_RESPONSE_MB = 16
+CHUNK_SIZE = 64 * 1024
+# 不参与请求合并键的参数：timeout 由各调用方的时间预算决定，不影响查询结果；
+# 共享结果为服务端超时时，等待方会单独重试，见 get_json
+FLIGHT_IGNORED_PARAMS = ("timeout",)
+# 时间参数在合并键中截断到整秒，几乎同时发起的相对时间查询可以合并
+FLIGHT_TIME_PARAMS = ("start", "end", "time")
+
+# 进程内共享，合并并发的相同查询
+_flights = SingleFlight()
+
+
+class ResponseTooLargeError(Exception):
+    """响应体超过允许的最大字节数"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        super().__init__(
+            f"response exceeds the limit of {limit} bytes, "
+            f"use a larger step, a shorter time range or a narrower selector"
+        )
+
+
+def parse_max_response_bytes(value: Any) -> int:
+    """解析最大响应大小配置（单位MB），无效值时使用默认值"""
+    try:
+        mb = float(value)
+    except (ValueError, TypeError):
+        mb = DEFAULT_MAX_RESPONSE_MB
+    if mb <= 0:
+        mb = DEFAULT_MAX_RESPONSE_MB
+    return int(mb * 1024 * 1024)
+
+
+def read_limited(response: requests.Response, max_bytes: int, tracker: Optional[Any] = None) -> bytearray:
+    """
+    以流式方式读取响应体，超过 max_bytes 时立即中断下载
+
+    response 需要以 stream=True 发起请求；直接返回bytearray，避免再复制一份（json.loads 可直接解析）
+    """
+    try:
+        content_length = response.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise ResponseTooLargeError(max_bytes)
+
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            body.extend(chunk)
+            if len(body) > max_bytes:
+                raise ResponseTooLargeError(max_bytes)
+    finally:
+        response.close()
+
+    if tracker is not None:
+        tracker.add_response(len(body))
+        tracker.sample_rss()
+    return body
+
+
+def get_json(url: str, params: dict, headers: dict, timeout: float,
+             max_bytes: int, tracker: Optional[Any] = None) -> tuple:
+    """
+    发送GET请求并在大小限制内解析JSON
+
+    并发的相同请求（endpoint、路径、参数、认证信息、大小限制相同）只会发出一次，
+    所有调用方共享同一个解析结果，调用方不能修改返回的对象；
+    共享的结果是服务端查询超时时（领头请求的超时可能更短），等待方会单独请求一次
+
+    返回 (status_code, 解析后的JSON或错误文本)
+    """
+    def fetch() -> tuple:
+        response = requests.get(url, params=params, headers=headers, timeout=timeout, stream=True)
+        body = read_limited(response, max_bytes, tracker)
+
+        if response.status_code != 200:
+            return response.status_code, body.decode("utf-8", errors="replace")
+        result = json.loads(body)
+        if tracker is not None:
+            # 解码后的对象与原始字节同时存在，此时内存占用最高
+            tracker.sample_rss()
+        return response.status_code, result
+
+    try:
+        result, coalesced = _flights.do(_flight_key(url, params, headers, max_bytes), fetch, timeout,
+                                        retry_if=lambda shared: is_query_timeout(*shared))
+    except TimeoutError as e:
+        raise requests.Timeout(str(e)) from e
+
+    if coalesced and tracker is not None:
+        tracker.add_coalesced()
+    return result
+
+
+def flight_stats() -> dict:
+    """请求合并的计数：调用总数、实际请求数、节省的请求数"""
+    return _flights.stats()
+
+
+def _flight_key(url: str, params: dict, headers: dict, max_bytes: int) -> tuple:
+    normalized = tuple(sorted(
+        (str(key), _flight_value(key, value)) for key, value in params.items() if key not in FLIGHT_IGNORED_PARAMS
+    ))
+    # 不同凭证可能看到不同的数据，只合并认证信息相同的请求
+    auth = headers.get("Authorization", "")
+    auth_digest = hashlib.sha256(auth.encode("utf-8")).hexdigest() if auth else ""
+    return url.rstrip("/"), normalized, auth_digest, max_bytes
+
+
+def _flight_value(key: str, value: Any) -> str:
+    if key in FLIGHT_TIME_PARAMS:
+        try:
+            return str(int(float(value)))
+        except (ValueError, TypeError):
+            # RFC3339 等非数字格式原样比较
+            pass
+    return str(value)
+
+
+def is_query_timeout(status_code: int, result: Any) -> bool:
+    """判断是否为Prometheus服务端查询超时（HTTP 503, errorType=timeout）"""
+    return status_code == 503 and isinstance(result, str) and '"timeout"' in result
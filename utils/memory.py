@@ -0,0 +1,110 @@
+from typing import Optional
+import logging
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+from dify_plugin.config.logger_format import plugin_logger_handler
+
+from utils import http
+
+# 与 dify_plugin 自身的logger一致，输出到插件日志
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(plugin_logger_handler)
+
+
+class MemoryTracker:
+    """
+    记录单次工具调用的内存使用情况，用于评估worker的内存配置
+
+    按调用统计:
+    - 响应体字节数（总量与单次最大值）
+    - 与其他并发调用合并、未实际发出的请求数
+    - 调用开始与结束时的进程RSS及其差值，以及调用期间采样到的RSS峰值
+      （每次下载响应体和解析JSON后采样；并发调用共享同一进程，数值会互相影响）
+
+    进程级别（单独记录，不能归因到某次调用）:
+    - 进程生命周期内的RSS峰值（ru_maxrss）
+    - 若已开启 tracemalloc（如设置 PYTHONTRACEMALLOC=1），开启以来的Python堆峰值
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.response_bytes_total = 0
+        self.response_bytes_peak = 0
+        self.responses = 0
+        self.coalesced = 0
+        self.rss_start: Optional[int] = None
+        self.rss_end: Optional[int] = None
+        self.rss_peak: Optional[int] = None
+        self._started = 0.0
+
+    def add_response(self, size: int) -> None:
+        self.responses += 1
+        self.response_bytes_total += size
+        self.response_bytes_peak = max(self.response_bytes_peak, size)
+
+    def sample_rss(self) -> None:
+        """采样当前RSS并更新峰值，在内存占用可能最高的位置调用"""
+        rss = _current_rss_bytes()
+        if rss is not None and (self.rss_peak is None or rss > self.rss_peak):
+            self.rss_peak = rss
+
+    def add_coalesced(self) -> None:
+        """记录一次与其他调用合并、未实际发出的请求"""
+        self.coalesced += 1
+
+    def __enter__(self) -> "MemoryTracker":
+        self._started = time.monotonic()
+        self.rss_start = _current_rss_bytes()
+        self.rss_peak = self.rss_start
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        self.rss_end = _current_rss_bytes()
+        self.sample_rss()
+        logger.info("%s invocation stats: %s, process stats: %s, coalescing: %s",
+                    self.name, self.stats(), process_stats(), http.flight_stats())
+
+    def stats(self) -> dict:
+        rss_delta = None
+        if self.rss_start is not None and self.rss_end is not None:
+            rss_delta = self.rss_end - self.rss_start
+        return {
+            "duration_ms": round((time.monotonic() - self._started) * 1000),
+            "responses": self.responses,
+            "coalesced": self.coalesced,
+            "response_bytes_total": self.response_bytes_total,
+            "response_bytes_peak": self.response_bytes_peak,
+            "rss_start_bytes": self.rss_start,
+            "rss_end_bytes": self.rss_end,
+            "rss_delta_bytes": rss_delta,
+            "rss_peak_sampled_bytes": self.rss_peak,
+        }
+
+
+def process_stats() -> dict:
+    """进程级别的内存峰值，不区分调用"""
+    heap_peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    return {
+        "process_rss_high_water_bytes": _max_rss_bytes(),
+        "process_heap_peak_bytes": heap_peak,
+    }
+
+
+def _current_rss_bytes() -> Optional[int]:
+    """当前进程RSS，仅支持Linux（/proc），其他平台返回 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _max_rss_bytes() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位为KB，macOS 上为字节
+    return rss if sys.platform == "darwin" else rss * 1024
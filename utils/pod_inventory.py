@@ -0,0 +1,210 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Pattern, Set, Tuple
+import hashlib
+import re
+import threading
+import time
+
+# 增量刷新间隔（秒）：超过该时间后同步Pod成员，移除已删除的Pod，只为新Pod拉取标签
+INVENTORY_TTL = 30
+# 全量刷新间隔（秒）：超过该时间后重新拉取完整清单（包括已有Pod的标签变化）
+INVENTORY_FULL_TTL = 300
+# 最多缓存的清单数量 (endpoint, 认证信息, namespace, 服务端名称过滤)，超出后淘汰最久未使用的
+MAX_INVENTORIES = 64
+
+QueryFunc = Callable[[str], Dict[str, Any]]
+
+
+class InvalidPatternError(ValueError):
+    """Pod名称正则无法编译"""
+
+
+class PodInventory:
+    """单个 (endpoint, namespace, 服务端名称过滤) 的Pod清单索引"""
+
+    def __init__(self):
+        # (namespace, pod) -> {'name', 'namespace', 'node', 'labels'}
+        self.pods: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.refreshed_at = 0.0
+        self.full_refreshed_at = 0.0
+        # 只保护索引状态的读写，不在持有锁时发起Prometheus查询
+        self.lock = threading.Lock()
+
+    def filter(self, selector: str, name_re: Optional[Pattern], limit: int) -> List[Dict[str, Any]]:
+        """在本地索引上按标签选择器和Pod名称正则过滤"""
+        matchers = _parse_selector(selector)
+
+        pods = []
+        for key in sorted(self.pods):
+            pod = self.pods[key]
+            if name_re and not name_re.fullmatch(pod['name']):
+                continue
+            if not all(_label_matches(pod['labels'], k, v) for k, v in matchers):
+                continue
+            pods.append({'name': pod['name'], 'namespace': pod['namespace'], 'node': pod['node']})
+            if len(pods) >= limit:
+                break
+        return pods
+
+
+_inventories: "OrderedDict[Tuple[str, str, str, str], PodInventory]" = OrderedDict()
+_inventories_lock = threading.Lock()
+
+
+def get_pods(api_url: str, headers: Dict[str, str], namespace: str,
+             selector: str, pod_name_pattern: str, query: QueryFunc,
+             limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    从缓存的Pod清单中获取匹配的Pod列表
+
+    清单按 (endpoint, 认证信息, namespace) 缓存，过期后先做增量刷新（只查询
+    当前Pod成员，移除已删除的Pod，并只为新增的Pod拉取标签），超过全量刷新间隔
+    再重新拉取完整清单。未指定namespace时，pod_name_pattern 仍在服务端过滤
+    （并作为缓存键的一部分），避免下载整个集群的 kube_pod_labels。
+
+    查询在锁外执行，并发刷新时相同的查询会被请求合并；
+    pod_name_pattern 无法编译时抛出 InvalidPatternError
+    """
+    # Prometheus 的 =~ 是全匹配，这里保持一致；注意这里使用Python re语法，与Prometheus的RE2略有差异
+    try:
+        name_re = re.compile(pod_name_pattern) if pod_name_pattern else None
+    except re.error as e:
+        raise InvalidPatternError(f"invalid pod_name_pattern {pod_name_pattern!r}: {e}") from e
+
+    server_pattern = '' if namespace else pod_name_pattern
+    inventory = _get_inventory(api_url, headers, namespace, server_pattern)
+    matcher = _pod_matcher(namespace, server_pattern)
+
+    with inventory.lock:
+        now = time.time()
+        full_refresh = now - inventory.full_refreshed_at >= INVENTORY_FULL_TTL
+        incremental_refresh = not full_refresh and now - inventory.refreshed_at >= INVENTORY_TTL
+        known = set(inventory.pods)
+
+    if full_refresh:
+        pod_data = query(f'kube_pod_labels{matcher}')
+        if pod_data:
+            pods = _parse_pods(pod_data.get('data', {}).get('result', []))
+            with inventory.lock:
+                inventory.pods = pods
+                inventory.full_refreshed_at = now
+                inventory.refreshed_at = now
+    elif incremental_refresh:
+        refreshed = _refresh_members(known, namespace, matcher, query)
+        if refreshed is not None:
+            members, new_pods = refreshed
+            with inventory.lock:
+                inventory.pods = {key: pod for key, pod in {**inventory.pods, **new_pods}.items()
+                                  if key in members}
+                inventory.refreshed_at = now
+
+    with inventory.lock:
+        return inventory.filter(selector, name_re, limit)
+
+
+def _refresh_members(known: Set[Tuple[str, str]], namespace: str, matcher: str,
+                     query: QueryFunc) -> Optional[Tuple[Set[Tuple[str, str]], Dict[Tuple[str, str], Dict[str, Any]]]]:
+    """
+    增量刷新：查询当前存在的Pod，只为新增的Pod查询标签
+
+    返回 (当前Pod集合, 新增Pod的索引)，查询失败时返回 None
+    """
+    member_data = query(f'group by (namespace, pod) (kube_pod_labels{matcher})')
+    if not member_data:
+        return None
+
+    members = set()
+    for item in member_data.get('data', {}).get('result', []):
+        metric = item.get('metric', {})
+        if metric.get('pod'):
+            members.add((metric.get('namespace', ''), metric['pod']))
+
+    new_keys = members - known
+    if not new_keys:
+        return members, {}
+    # 与工具中的查询一致，Pod名称直接拼接为正则；多匹配的结果在下面按键过滤掉
+    pod_names = '|'.join(sorted(pod for _, pod in new_keys))
+    namespace_matcher = f'namespace="{namespace}", ' if namespace else ''
+    label_data = query(f'kube_pod_labels{{{namespace_matcher}pod=~"{pod_names}"}}')
+    if not label_data:
+        # 拿不到新Pod的标签时，先只移除已删除的Pod
+        return members - new_keys, {}
+    # 不同命名空间可能存在同名Pod，只加载新增的那些
+    new_pods = {key: pod for key, pod in _parse_pods(label_data.get('data', {}).get('result', [])).items()
+                if key in new_keys}
+    return members, new_pods
+
+
+def _parse_pods(result: List[Dict[str, Any]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """将 kube_pod_labels 的查询结果转换为索引"""
+    pods = {}
+    for item in result:
+        metric = item.get('metric', {})
+        pod_name = metric.get('pod', '')
+        if not pod_name:
+            continue
+        pod_namespace = metric.get('namespace', '')
+        labels = {key: value for key, value in metric.items()
+                  if key not in ('__name__', 'pod', 'namespace', 'node')}
+        pods[(pod_namespace, pod_name)] = {
+            'name': pod_name,
+            'namespace': pod_namespace,
+            'node': metric.get('node', ''),
+            'labels': labels,
+        }
+    return pods
+
+
+def clear() -> None:
+    """清空所有缓存的Pod清单"""
+    with _inventories_lock:
+        _inventories.clear()
+
+
+def _get_inventory(api_url: str, headers: Dict[str, str], namespace: str, server_pattern: str) -> PodInventory:
+    # 不同凭证在同一endpoint上可能看到不同的数据，缓存键中加入认证信息摘要
+    auth = headers.get('Authorization', '')
+    auth_digest = hashlib.sha256(auth.encode('utf-8')).hexdigest() if auth else ''
+    key = (api_url.rstrip('/'), auth_digest, namespace, server_pattern)
+
+    with _inventories_lock:
+        inventory = _inventories.get(key)
+        if inventory is None:
+            inventory = PodInventory()
+            _inventories[key] = inventory
+            while len(_inventories) > MAX_INVENTORIES:
+                _inventories.popitem(last=False)
+        else:
+            _inventories.move_to_end(key)
+        return inventory
+
+
+def _pod_matcher(namespace: str, pod_name_pattern: str) -> str:
+    if namespace:
+        return f'{{namespace="{namespace}"}}'
+    if pod_name_pattern:
+        return f'{{pod=~"{pod_name_pattern}"}}'
+    return ''
+
+
+def _parse_selector(selector: str) -> List[Tuple[str, str]]:
+    """将selector (key=value,key2=value2) 解析为键值对列表"""
+    matchers = []
+    if not selector:
+        return matchers
+    for s in selector.split(','):
+        if '=' in s:
+            k, v = s.strip().split('=', 1)
+            matchers.append((k.strip(), v.strip()))
+    return matchers
+
+
+def _label_matches(labels: Dict[str, str], key: str, value: str) -> bool:
+    """
+    kube-state-metrics 会把Pod标签导出为 label_<key>，并把非法字符替换为下划线，
+    因此同时兼容原始标签名与导出后的标签名
+    """
+    if key in labels:
+        return labels[key] == value
+    exported = 'label_' + re.sub(r'[^a-zA-Z0-9_]', '_', key)
+    return labels.get(exported) == value
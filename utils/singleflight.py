@@ -0,0 +1,78 @@
+from typing import Any, Callable, Dict, Hashable, Optional
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    合并并发的相同请求：同一个key同时只有一个请求在执行，
+    其余调用方等待（最多等待自己的时间预算）并共享同一个结果（或异常）
+
+    领头请求的服务端超时可能比等待方短；等待方可以通过 retry_if 判断共享结果
+    是否为超时，此时再单独发起一次请求
+
+    共享的结果对象会被多个调用方同时读取，调用方不能修改它
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        # 调用总数、实际发出的请求数、被合并（节省）的请求数
+        self.requests = 0
+        self.upstream = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: float,
+           retry_if: Optional[Callable[[Any], bool]] = None) -> tuple:
+        """
+        执行 fn 或等待正在执行的相同请求，timeout 为调用方的时间预算（秒）
+
+        共享结果满足 retry_if 时，等待方单独执行一次 fn
+        返回 (结果, 是否为合并的请求)；等待超过 timeout 时抛出 TimeoutError
+        """
+        with self._lock:
+            self.requests += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.upstream += 1
+
+        if not leader:
+            if not call.event.wait(timeout):
+                raise TimeoutError("timed out waiting for an identical in-flight request")
+            if call.error is None and retry_if is not None and retry_if(call.result):
+                with self._lock:
+                    self.upstream += 1
+                return fn(), False
+            with self._lock:
+                self.coalesced += 1
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "upstream": self.upstream,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+            }
@@ -0,0 +1,131 @@
+from functools import lru_cache
+from typing import Optional, Tuple
+import datetime
+import re
+import time
+
+# 时长单位（秒），与Prometheus一致，另外兼容 'M'（按30天计）
+DURATION_UNITS = {
+    'ms': 0.001,
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+    'w': 604800,
+    'M': 2592000,
+    'y': 31536000,
+}
+
+# 单个时长片段，如 '1h'、'1.5d'、'500ms'；复合时长由多个片段组成，如 '1h30m'
+_DURATION_PART_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h|d|w|M|y)')
+_DURATION_RE = re.compile(r'(?:\d+(?:\.\d+)?(?:ms|s|m|h|d|w|M|y))+')
+_NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+# 相对于当前时间的表达式，如 'now-1h30m'
+_NOW_OFFSET_RE = re.compile(r'now\s*([+-])\s*(\S+)')
+
+# Prometheus 单个序列最多返回的点数
+MAX_POINTS = 11000
+# 最小步长（秒），Prometheus 的时间精度为毫秒
+MIN_STEP = 0.001
+
+
+@lru_cache(maxsize=256)
+def parse_duration(value: str) -> float:
+    """
+    解析时长字符串，返回秒数
+
+    支持纯数字（秒）以及单个或复合时长，如 '15s'、'5m'、'1h30m'、'1.5d'
+    """
+    text = str(value).strip()
+    if _NUMBER_RE.fullmatch(text):
+        return float(text)
+    if not _DURATION_RE.fullmatch(text):
+        raise ValueError(f"invalid duration: {value!r}")
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in _DURATION_PART_RE.findall(text))
+
+
+def parse_datetime(value: str) -> float:
+    """
+    解析RFC3339/ISO8601时间，返回Unix时间戳
+
+    不做缓存，适合逐个样本调用；用户输入的时间参数走带缓存的 parse_timestamp
+    """
+    text = str(value).strip()
+    if text.endswith(('z', 'Z')):
+        text = text[:-1] + '+00:00'
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        pass
+
+    # 非标准的ISO8601写法（如 '20230101T000000Z'、纳秒精度）才退回到 dateutil；
+    # 只接受ISO8601，避免 '-1h'、'1 hour' 这类输入被宽松地解析成当天的某个时刻
+    from dateutil import parser
+    try:
+        return parser.isoparse(str(value).strip()).timestamp()
+    except (ValueError, OverflowError) as e:
+        raise ValueError(f"invalid time: {value!r}") from e
+
+
+# 用户输入的开始/结束时间取值有限，缓存解析结果
+_cached_parse_datetime = lru_cache(maxsize=256)(parse_datetime)
+
+
+def parse_timestamp(value: str, now: Optional[float] = None) -> float:
+    """
+    解析时间参数，返回Unix时间戳，支持:
+    - 'now'，以及 'now-1h' 这样的相对表达式
+    - 相对时长，表示当前时间之前，如 '1h'、'2d'、'1h30m'
+    - Unix时间戳，如 '1700000000' 或 '1700000000.5'
+    - RFC3339/ISO8601格式，如 '2023-01-01T00:00:00Z'
+    """
+    if now is None:
+        now = time.time()
+    text = str(value).strip()
+
+    if text.lower() == 'now':
+        return now
+
+    match = _NOW_OFFSET_RE.fullmatch(text)
+    if match:
+        sign, duration = match.groups()
+        offset = parse_duration(duration)
+        return now + offset if sign == '+' else now - offset
+
+    if _DURATION_RE.fullmatch(text):
+        return now - parse_duration(text)
+
+    # 纯数字视为Unix时间戳（秒）
+    if _NUMBER_RE.fullmatch(text):
+        return float(text)
+
+    return _cached_parse_datetime(text)
+
+
+def parse_range(start: str, end: str, step: str, max_points: int = MAX_POINTS) -> Tuple[float, float, float]:
+    """
+    解析范围查询的开始时间、结束时间和步长
+
+    相对时间都以同一个当前时间为基准，并取整到秒，使相近时刻发起的相同查询参数一致、
+    可以被请求合并；步长会在必要时放大，使每个序列的点数不超过Prometheus的上限
+    """
+    now = float(int(time.time()))
+    start_timestamp = parse_timestamp(start, now)
+    end_timestamp = parse_timestamp(end, now)
+    if start_timestamp > end_timestamp:
+        raise ValueError(f"start time {start!r} is after end time {end!r}")
+
+    step_seconds = parse_duration(step)
+    if step_seconds < MIN_STEP:
+        raise ValueError(f"step must be at least {MIN_STEP}s: {step!r}")
+    min_step = (end_timestamp - start_timestamp) / max_points
+    if step_seconds < min_step:
+        step_seconds = float(int(min_step) + 1)
+
+    return start_timestamp, end_timestamp, step_seconds
+
+
+def format_seconds(value: float) -> str:
+    """将秒数格式化为Prometheus API参数，整数不带小数部分"""
+    text = f"{float(value):.6f}".rstrip('0').rstrip('.')
+    return text or '0'